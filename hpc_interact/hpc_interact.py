@@ -1,13 +1,88 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import glob
+import sys
+import time
+import shlex
+import select
+import signal
+import posixpath
+import subprocess
+import threading
+from collections import deque
+from functools import lru_cache, cached_property
+from contextlib import nullcontext
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from itertools import groupby
 from pathlib import Path
 from typing import List
 from getpass import getpass
 
 def fix_quote(string):
-    """Returns `string` with double quotes converted (" -> \")"""
-    return str(string).replace('"','\\"')
+    """Returns `string` escaped for a double-quoted Tcl string (\\ " $ [ -> \\\\ \\" \\$ \\[), so `expect` sends it literally"""
+    string = str(string).replace('\\','\\\\')
+    for char in '"$[':
+        string = string.replace(char,'\\'+char)
+    return string
+
+# `expect`/`send` templates and escaping by quote symbol. Single quotes become Tcl braces, so nothing inside is interpolated.
+_EXPECT_TMPL = {'"': 'expect "{}"', "'": 'expect {{{}}}'}
+_ACTION_TMPL = {'"': 'send -- "{}\n"', "'": 'send -- {{{}\n}}'}
+_ESCAPE = {'"': fix_quote, "'": str}
+
+def _brace_safe(text):
+    """True if `text` can sit inside Tcl braces verbatim (no backslashes, braces balanced)"""
+
+    depth = 0
+    for char in text:
+        if char == "\\":
+            return False
+        depth += {"{": 1, "}": -1}.get(char,0)
+        if depth < 0:
+            return False
+    return depth == 0
+
+def _render(templates,quote,text):
+    """Fills the `quote` template from `templates` with `text`, falling back to an escaped double-quoted
+    string if `text` can't be brace-quoted (either way, nothing in `text` is interpolated)"""
+
+    if quote == "'" and not _brace_safe(text):
+        quote = '"'
+    return templates[quote].format(_ESCAPE[quote](text))
+
+# per-mode settings: command that ends the session, prompt to expect (None: the username),
+# commands to change the remote/local directory (None: unsupported), and whether put/get are available
+_MODE_CFG = MappingProxyType({
+    "sftp": MappingProxyType({"end": "quit", "prompt": "sftp>", "cd": "cd", "lcd": "lcd", "transfer": True}),
+    "ssh": MappingProxyType({"end": "exit", "prompt": None, "cd": "cd", "lcd": None, "transfer": False}),
+})
+
+def _quote_arg(arg):
+    """Returns `arg` shell-quoted if it contains whitespace or quotes, else unchanged (so globs and `~` still expand)"""
+
+    if any(c.isspace() or c in "'\"\\" for c in arg):
+        return shlex.quote(arg)
+    return arg
+
+_CRED_RE = re.compile(r'^(username|password|group|site)\s*=\s*(.*)$',re.I)
+
+@lru_cache(maxsize=32)
+def _load_config(path:str):
+    """Returns a read-only dict of credentials found in config file `path`
+
+    Cached per path, so repeated Scripters don't re-read the same file. Call `_load_config.cache_clear()` after changing a config.
+    """
+
+    creds = {}
+    for line in Path(path).read_text().splitlines():
+        m = _CRED_RE.match(line.strip())
+        if m:
+            creds[m.group(1).lower()] = m.group(2).strip()
+    return MappingProxyType(creds)
 
 class Step:
     """A class to hold the expect and send commands that will be fed to `expect` on the command line
@@ -16,21 +91,61 @@ class Step:
         expect (str): the prompt to expect before acting
         cmd (str): the command to send
         mode (str, optional): how to connect to the host (options: [sftp, ssh]). Defaults to "sftp".
-        quote (str, optional): The quotation symbol to use (in case the other one is part of the string). Defaults to '"'.
+        input_quote (str, optional): The quotation symbol to use for `cmd` (in case the other one is part of the string). Defaults to '"'.
+        expect_quote (str, optional): The quotation symbol to use for `expect`. Defaults to '"'.
+        op (str, optional): the command name (e.g. put, cd), used by backends that don't go through `expect`
+        args (list, optional): the arguments passed to `op`
     """
 
-    def __init__(self,expect,cmd,input_quote='"',expect_quote='"') -> None:
+    def __init__(self,expect,cmd=None,input_quote='"',expect_quote='"',op=None,args=None) -> None:
         """Creates a step to use with `expect` 
 
+        Either `cmd` or `op` must be provided. If only `op` (and `args`) are given, `cmd` is built from them
+        (quoting any argument containing whitespace or quotes).
+        The text sent to `expect` is only rendered when first needed.
+
         Args:
             expect (str): the prompt to expect before acting
-            cmd (str): the command to send
+            cmd (str, optional): the command to send
             mode (str, optional): how to connect to the host (options: [sftp, ssh]). Defaults to "sftp".
-            quote (str, optional): The quote symbol to use (in case the other one is part of the string). Defaults to '"'. Not fully employed everywhere. Single quotes ensure no interpolation of the command.
+            input_quote (str, optional): The quote symbol to use for `cmd` (in case the other one is part of the string). Defaults to '"'. Single quotes ensure no interpolation of the command.
+            expect_quote (str, optional): The quote symbol to use for `expect`. Defaults to '"'.
+            op (str, optional): the command name (e.g. put, cd), used by backends that don't go through `expect`
+            args (list, optional): the arguments passed to `op`
         """
 
-        self.expectation = f'expect "{fix_quote(expect)}"'
-        self.action = f'send -- "{fix_quote(cmd)}\n"'
+        self.op = op
+        self.args = [str(arg) for arg in args] if args else []
+        self.prompt = str(expect)
+        self.input_quote = input_quote
+        self.expect_quote = expect_quote
+        self._cmd = cmd
+
+    @cached_property
+    def cmd(self):
+        """The command to send"""
+
+        if self._cmd is None:
+            return " ".join([self.op] + [_quote_arg(arg) for arg in self.args])
+        return str(self._cmd)
+
+    @cached_property
+    def expectation(self):
+        """The `expect` statement"""
+
+        return _render(_EXPECT_TMPL,self.expect_quote,self.prompt)
+
+    @cached_property
+    def action(self):
+        """The `send` statement"""
+
+        return _render(_ACTION_TMPL,self.input_quote,self.cmd)
+
+    @cached_property
+    def _rendered(self):
+        """The `expect` and `send` statements, as used in the `expect` script"""
+
+        return f"{self.expectation}\n{self.action}\n"
 
     def __repr__(self,sep="\n") -> str:
         """Prints the Step with the expect statement and action seperated by `sep`
@@ -39,8 +154,361 @@ class Step:
             sep (str): string by which to seperate each statement
         """
 
-        action_fixed_quotes = self.action #.replace('"','\\"')
-        return f"{self.expectation}{sep}{action_fixed_quotes}{sep}"
+        if sep == "\n":
+            return self._rendered
+        return f"{self.expectation}{sep}{self.action}{sep}"
+
+class _ParamikoBackend:
+    """Runs a list of Steps over a single paramiko connection instead of through `expect`
+
+    * The server's host key must already be in your known_hosts (as it would be after connecting once with `ssh`/`sftp`).
+        Unknown hosts and mismatched keys are refused before any credentials are sent.
+    * Authentication happens once, answering the same prompts as the `expect` password steps.
+    * In sftp mode, each Step is dispatched by its `op` directly against the SFTP API.
+    * In ssh mode, each Step's command is sent to a single remote shell.
+    * Like the sftp/ssh clients, a failing step is reported and the remaining steps still run.
+    * If `parallel` > 1, the files matched by a globbed `put`/`get` are transferred concurrently,
+        and consecutive `chmod`/`chgrp` steps are applied concurrently,
+        each worker thread using its own sftp channel on the same connection.
+
+    Arguments:
+        site (str): The hpc cluster to reach
+        username (str): Your username
+        password (str): Your password
+        mode (str): How to connect. Options: (sftp, ssh)
+        pw_steps (list[Step]): Steps whose prompt/command pairs answer login prompts
+        port (int, optional): The port to connect to. Defaults to 22.
+        parallel (int, optional): The max number of concurrent file transfers. Defaults to 1.
+    """
+
+    known_hosts_files = ("~/.ssh/known_hosts","/etc/ssh/ssh_known_hosts")
+    # known_hosts key names whose keys are negotiated under other algorithm names
+    host_key_algorithms = {"ssh-rsa": ("rsa-sha2-512","rsa-sha2-256","ssh-rsa")}
+
+    def __init__(self,site,username,password,mode,pw_steps,port=22,parallel=1):
+        self.site = site
+        self.username = username
+        self.password = password
+        self.mode = mode
+        self.pw_steps = pw_steps
+        self.port = port
+        self.parallel = int(parallel)
+        self.errors = (OSError,) # failures reported per step; paramiko's SSHException is added on connect
+        self.transport = None
+        self.sftp = None
+        self.pool = None
+        self._thread_clients = threading.local()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+        self._shared_lock = threading.Lock() # workers falling back to the main session take turns on it
+        self.lcwd = os.getcwd()
+        self.ops = {
+            "put": self.put,
+            "get": self.get,
+            "mkdir": self.mkdir,
+            "lmkdir": self.lmkdir,
+            "chmod": self.chmod,
+            "chgrp": self.chgrp,
+            "cd": self.cd,
+            "lcd": self.lcd,
+            "ls": self.ls,
+            "pwd": self.pwd,
+            "quit": self.quit,
+        }
+
+    def _answer_prompts(self,title,instructions,prompts):
+        """Answers keyboard-interactive prompts using `pw_steps` (falls back to the password)"""
+
+        answers = []
+        for prompt,_ in prompts:
+            for step in self.pw_steps:
+                if step.prompt.rstrip(":").lower() in prompt.lower():
+                    answers.append(step.cmd)
+                    break
+            else:
+                answers.append(self.password)
+        return answers
+
+    def connect(self):
+        """Opens and authenticates the connection (and sftp session, if in sftp mode)"""
+
+        try:
+            import paramiko
+        except ImportError:
+            raise ImportError("backend='paramiko' requires paramiko (pip install hpc-interact[paramiko])") from None
+        self.errors = (OSError,paramiko.SSHException)
+        host_keys = paramiko.HostKeys()
+        for known_hosts in self.known_hosts_files:
+            known_hosts = os.path.expanduser(known_hosts)
+            if os.path.exists(known_hosts):
+                host_keys.load(known_hosts)
+        host = self.site if self.port == 22 else f"[{self.site}]:{self.port}"
+        known_keys = host_keys.lookup(host)
+        not_found = f"Host key for '{host}' not found in known_hosts. Connect once with `ssh` or `sftp` to verify and save it."
+        if not known_keys:
+            raise paramiko.SSHException(not_found)
+        self.transport = paramiko.Transport((self.site,self.port))
+        # only negotiate host key types we can verify
+        algorithms = {alg for name in known_keys for alg in self.host_key_algorithms.get(name,(name,))}
+        options = self.transport.get_security_options()
+        key_types = [key_type for key_type in options.key_types if key_type in algorithms]
+        if not key_types:
+            raise paramiko.SSHException(not_found)
+        options.key_types = key_types
+        self.transport.connect()
+        server_key = self.transport.get_remote_server_key()
+        if not host_keys.check(host,server_key):
+            expected = known_keys.get(server_key.get_name()) or next(iter(known_keys.values()))
+            raise paramiko.BadHostKeyException(host,server_key,expected)
+        try:
+            self.transport.auth_interactive(self.username,self._answer_prompts)
+        except paramiko.BadAuthenticationType:
+            self.transport.auth_password(self.username,self.password)
+        if self.mode == "sftp":
+            self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+            if self.parallel > 1:
+                self.pool = ThreadPoolExecutor(max_workers=self.parallel)
+
+    def close(self):
+        """Closes the sftp session(s) and connection"""
+
+        if self.pool:
+            self.pool.shutdown()
+        for client in self._clients:
+            client.close()
+        if self.sftp:
+            self.sftp.close()
+        if self.transport:
+            self.transport.close()
+
+    def check(self,steps:List[Step]):
+        """Raises an Exception if any step can't be run by this backend"""
+
+        if self.mode != "sftp":
+            return
+        for step in steps:
+            if step.op is None and step.cmd.startswith(("#","!")):
+                continue
+            if step.op not in self.ops:
+                raise Exception(f"Step '{step.cmd}' can't be run with backend='paramiko'. Use basic_step() or backend='expect'.")
+            if step.op in ("put","get") and step.args and step.args[0].startswith("-"):
+                raise Exception(f"Transfer options ({step.args[0]}) are not supported with backend='paramiko'")
+
+    def run(self,steps:List[Step]):
+        """Connects, runs all `steps` in order, then disconnects"""
+
+        self.check(steps)
+        try:
+            self.connect()
+            if self.mode == "sftp":
+                for is_attr,group in groupby(steps,key=lambda step: step.op in ("chmod","chgrp")):
+                    if is_attr and self.pool:
+                        self.set_attributes(list(group))
+                    else:
+                        for step in group:
+                            self.dispatch(step)
+            else:
+                self.run_shell(steps)
+        finally:
+            self.close()
+
+    def dispatch(self,step:Step):
+        """Runs a single sftp step, reporting (not raising) any failure"""
+
+        print(f"sftp> {step.cmd}")
+        try:
+            if step.op is None:
+                if step.cmd.startswith("!"):
+                    subprocess.run(step.cmd[1:],shell=True,cwd=self.lcwd)
+                return
+            self.ops[step.op](*step.args)
+        except self.errors as e:
+            print(f"{step.cmd}: {e}")
+
+    def run_shell(self,steps:List[Step]):
+        """Sends each step's command to one remote shell and streams its output to stdout"""
+
+        channel = self.transport.open_session()
+        channel.invoke_shell()
+        for step in steps:
+            channel.sendall(f"{step.cmd}\n".encode())
+        while True:
+            data = channel.recv(65536)
+            if not data:
+                break
+            os.write(1,data)
+        channel.close()
+
+    def _local(self,path):
+        """Returns `path` relative to the local working directory"""
+
+        return os.path.join(self.lcwd,os.path.expanduser(path))
+
+    def _expand_remote(self,pattern):
+        """Returns remote paths matching `pattern` (only the last path component may be a glob)"""
+
+        if not any(c in pattern for c in "*?["):
+            return [pattern]
+        parent,name = posixpath.split(pattern)
+        return [posixpath.join(parent,f) for f in sorted(self.sftp.listdir(parent or ".")) if fnmatch(f,name)]
+
+    def _expand_local(self,pattern):
+        """Returns local paths matching `pattern`"""
+
+        return sorted(glob.glob(self._local(pattern))) or [self._local(pattern)]
+
+    def _remote_abs(self,path,cwd=None):
+        """Returns remote `path` made absolute, so any sftp channel can use it"""
+
+        if posixpath.isabs(path):
+            return path
+        return posixpath.join(cwd or self.sftp.normalize("."),path)
+
+    def _thread_client(self):
+        """Returns this worker thread's sftp session, opening a new channel on first use"""
+
+        client = getattr(self._thread_clients,"sftp",None)
+        if client is None:
+            try:
+                client = self.sftp.from_transport(self.transport)
+                reason = "no channel opened"
+            except self.errors as e: # e.g. server's MaxSessions reached
+                reason = e
+            if client is None:
+                print(f"Couldn't open another sftp channel ({reason}). Sharing the main one (one transfer at a time).")
+                client = self.sftp
+            else:
+                with self._clients_lock:
+                    self._clients.append(client)
+            self._thread_clients.sftp = client
+        return client
+
+    def _run_job(self,method,args,threaded=False):
+        """Calls sftp `method` (or "chgrp") with `args`, reporting (not raising) any failure"""
+
+        try:
+            sftp = self._thread_client() if threaded else self.sftp
+            with self._shared_lock if threaded and sftp is self.sftp else nullcontext():
+                if method == "chgrp": # sftp has no chgrp; keep the owner
+                    path,gid = args
+                    sftp.chown(path,sftp.stat(path).st_uid,gid)
+                else:
+                    getattr(sftp,method)(*args)
+        except self.errors as e:
+            print(f"{method} {args[0]}: {e}")
+
+    def _run_all(self,jobs):
+        """Runs each (method, args) job, concurrently when possible"""
+
+        if self.pool and len(jobs) > 1:
+            list(self.pool.map(lambda job: self._run_job(*job,threaded=True),jobs))
+        else:
+            for job in jobs:
+                self._run_job(*job)
+
+    def _attribute_jobs(self,op,value,file,cwd=None):
+        """Returns (method, args) jobs applying `chmod`/`chgrp` `value` to remote `file` (which may be a glob)"""
+
+        if op == "chmod":
+            value = int(str(value),8)
+        else: value = int(value)
+        return [(op,(self._remote_abs(remote,cwd),value)) for remote in self._expand_remote(file)]
+
+    def set_attributes(self,steps:List[Step]):
+        """Applies a batch of `chmod`/`chgrp` steps together"""
+
+        cwd = self.sftp.normalize(".")
+        jobs = []
+        for step in steps:
+            print(f"sftp> {step.cmd}")
+            try:
+                jobs += self._attribute_jobs(step.op,*step.args,cwd=cwd)
+            except self.errors + (ValueError,) as e:
+                print(f"{step.cmd}: {e}")
+        self._run_all(jobs)
+
+    def put(self,file,new_name=None):
+        """Uploads `file` (which may be a glob) to `new_name` (a directory if it ends with '/')"""
+
+        cwd = self.sftp.normalize(".")
+        jobs = []
+        for local in self._expand_local(file):
+            if not new_name:
+                remote = os.path.basename(local)
+            elif new_name.endswith("/"):
+                remote = posixpath.join(new_name,os.path.basename(local))
+            else: remote = new_name
+            jobs.append(("put",(local,self._remote_abs(remote,cwd))))
+        self._run_all(jobs)
+
+    def get(self,file,new_name=None):
+        """Downloads `file` (which may be a glob) to `new_name` (a directory if it ends with '/')"""
+
+        cwd = self.sftp.normalize(".")
+        jobs = []
+        for remote in self._expand_remote(file):
+            if not new_name:
+                local = posixpath.basename(remote)
+            elif new_name.endswith("/"):
+                local = os.path.join(new_name,posixpath.basename(remote))
+            else: local = new_name
+            jobs.append(("get",(self._remote_abs(remote,cwd),self._local(local))))
+        self._run_all(jobs)
+
+    def mkdir(self,dir_name):
+        """Makes remote directory `dir_name`"""
+
+        self.sftp.mkdir(dir_name)
+
+    def lmkdir(self,dir_name):
+        """Makes local directory `dir_name`"""
+
+        os.mkdir(self._local(dir_name))
+
+    def chmod(self,octal,file):
+        """Sets permissions of remote `file` (which may be a glob) to `octal`"""
+
+        self._run_all(self._attribute_jobs("chmod",octal,file))
+
+    def chgrp(self,group,file):
+        """Sets group id of remote `file` (which may be a glob) to `group`"""
+
+        self._run_all(self._attribute_jobs("chgrp",group,file))
+
+    def cd(self,dir_name):
+        """Changes remote working directory"""
+
+        self.sftp.chdir(dir_name)
+
+    def lcd(self,dir_name):
+        """Changes local working directory (without changing that of the python process)"""
+
+        path = self._local(dir_name)
+        if not os.path.isdir(path):
+            raise OSError(f"Can't change directory: '{dir_name}'")
+        self.lcwd = path
+
+    def ls(self,*args):
+        """Prints long listings of remote paths (Default: current directory), ignoring options"""
+
+        paths = [arg for arg in args if not arg.startswith("-")] or ["."]
+        for path in paths:
+            if any(c in path for c in "*?["):
+                for remote in self._expand_remote(path):
+                    print(self.sftp.lstat(remote))
+            else:
+                for attr in self.sftp.listdir_attr(path):
+                    print(attr)
+
+    def pwd(self):
+        """Prints remote working directory"""
+
+        print(f"Remote working directory: {self.sftp.normalize('.')}")
+
+    def quit(self):
+        """Nothing to do - the connection is closed once all steps have run"""
+
+        pass
 
 class Scripter:
     """A class to connect to an hpc cluster via sftp or ssh all wrapped up in a scripted batch of expect statements.
@@ -60,9 +528,16 @@ class Scripter:
         group (str | int, optional): Group name to use if setting permissions. Defaults to None.
         config (str | Path, optional): Path to config file with credentials. Defaults to Path('~/hpc_config.txt').
         site_type (str, optional): What you'll be interacting with: [hpc, ncbi]. Defaults to "hpc".
+        backend (str, optional): How to run the steps: [expect, paramiko]. Defaults to "expect".
+        parallel (int, optional): Max number of files a globbed `put`/`get` transfers at once (paramiko backend only). Defaults to 1.
+        idle_timeout (int, optional): Seconds without any output after which `run()` stops `expect` (expect backend only). Defaults to None (no limit).
+        abs_timeout (int, optional): Seconds after which `run()` stops `expect` regardless (expect backend only). Defaults to None (no limit).
+        poll_timeout (float, optional): Max seconds `run()` waits for output before checking timeouts/interrupts (expect backend only). Defaults to 0.1.
     """
 
-    def __init__(self,username=None,password=None,site=None,mode="sftp",group=None,config=None,save_credentials=True,site_type="hpc"):
+    output_keep = 10000 # bytes of output kept from both the start and the end of each run()
+
+    def __init__(self,username=None,password=None,site=None,mode="sftp",group=None,config=None,save_credentials=True,site_type="hpc",backend="expect",parallel=1,idle_timeout=None,abs_timeout=None,poll_timeout=0.1):
         """Creates a Scripter instance
 
         Args:
@@ -73,6 +548,14 @@ class Scripter:
             group (str | int, optional): Group name to use if setting permissions. Defaults to None.
             config (str | Path, optional): Path to config file with credentials. Defaults to Path('~/hpc_config.txt').
             site_type (str, optional): What you'll be interacting with: [hpc, ncbi]. Defaults to "hpc".
+            backend (str, optional): How to run the steps. Defaults to "expect".
+                * "expect": script the sftp/ssh command line client via `expect`
+                * "paramiko": run steps over a single paramiko connection (requires `paramiko`)
+            parallel (int, optional): Max number of files a globbed `put`/`get` transfers at once (paramiko backend only). Defaults to 1.
+            idle_timeout (int, optional): Seconds without any output after which `run()` stops `expect` (expect backend only). Defaults to None (no limit).
+            abs_timeout (int, optional): Seconds after which `run()` stops `expect` regardless (expect backend only). Defaults to None (no limit).
+            poll_timeout (float, optional): Max seconds `run()` waits for output before checking timeouts/interrupts (expect backend only). Defaults to 0.1.
+                Smaller values react to `interrupt()`/`abs_timeout` sooner, at the cost of more wakeups while idle.
 
         Returns:
             Scripter: an object that builds an expect command for automating:
@@ -88,14 +571,33 @@ class Scripter:
             self.config=Path(config)
         else: self.config=None
         self.save_credentials = save_credentials
+        if backend not in ("expect","paramiko"):
+            raise Exception(f"Unknown backend '{backend}'. Options: (expect, paramiko)")
+        self.backend = backend
+        self.parallel = int(parallel)
+        if self.parallel < 1:
+            raise Exception(f"parallel must be at least 1 (got {parallel})")
+        if self.parallel > 9:
+            print(f"Warning: parallel={parallel} needs {self.parallel + 1} sftp channels, but many servers allow only 10 per connection (OpenSSH's MaxSessions default). "
+                "Extra workers will share the main channel.")
+        self.idle_timeout = idle_timeout
+        self.abs_timeout = abs_timeout
+        self.poll_timeout = poll_timeout
+        self._interrupted = threading.Event()
+        self.output_head = bytearray()
+        self.output_tail = deque(maxlen=self.output_keep)
+        self.output_size = 0
         self.get_credentials(save=save_credentials,overwrite=False)
         self.actions:List[Step] = []
+        self._cmd_cache = None
+        self._cmd_steps = None # the steps `_cmd_cache` was rendered from
+        self._dirty = True
         self.__pw_steps = [
             Step(expect="Password:", cmd=self.__password),
             Step(expect="Passcode or option (1-3):", cmd=1)]
         self.mode, self.expect, self.entry = self.reset_mode(mode)
-        self.open = f"expect << !\nset timeout -1\nspawn "
-        self.close = "expect eof\n!\n"
+        self.open = f"set timeout -1\nspawn "
+        self.close = "expect eof\n"
 
     def reset_mode(self,mode,clear=True):
         """Resets mode attributes (mode, expect, entry), and clears any actions.
@@ -105,13 +607,15 @@ class Scripter:
             clear (bool): A flag to clear any steps already added. Defaults to True.
         """
 
+        if mode not in _MODE_CFG:
+            raise Exception(f"Unknown mode '{mode}'. Options: ({', '.join(_MODE_CFG)})")
         if clear and self.actions:
             self.clear()
+        self._reset_tracked_dirs()
         self.mode = mode
-        if self.mode=="sftp":
-            self.expect = "sftp>"
-        else: # if self.mode=="ssh":
-            self.expect = self.username
+        self._m = _MODE_CFG[mode]
+        self._dirty = True
+        self.expect = self._m["prompt"] or self.username
         self.entry = f"{self.mode} {self.username}@{self.site}\n"
         return self.mode, self.expect, self.entry
 
@@ -126,7 +630,13 @@ class Scripter:
 
         if not expect: expect = self.expect
         step = Step(cmd=cmd,expect=expect,input_quote=input_quote,expect_quote=expect_quote)
+        self._check_tracked_dirs()
         self.actions.append(step)
+        self._dirty = True
+        words = str(cmd).split()
+        if words:
+            self._track_dir(words[0],[]) # can't be sure where a hand-written cd leads
+        self._tracked_mark = self._actions_mark()
 
     def basic_step(self,*commands,expect=None,input_quote='"',expect_quote='"'):
         """Adds a step by converting list of `commands` to a space-delimited string to run
@@ -137,9 +647,55 @@ class Scripter:
             quote (str, optional): The quote symbol to use (in case the other one is part of the string). Defaults to '"'. Not fully employed everywhere. Single quotes ensure no interpolation of the command.
         """
 
+        commands = [str(command) for command in commands if command]
         if commands:
-            command_str = " ".join([str(command) for command in commands if command])
-            self.add_step(command_str,expect=expect,input_quote=input_quote,expect_quote=expect_quote)
+            if not expect: expect = self.expect
+            step = Step(expect=expect,op=commands[0],args=commands[1:],input_quote=input_quote,expect_quote=expect_quote)
+            self._check_tracked_dirs()
+            self.actions.append(step)
+            self._dirty = True
+            self._track_dir(step.op,step.args)
+            self._tracked_mark = self._actions_mark()
+
+    @staticmethod
+    def _next_dir(current,dir_name):
+        """Returns the directory `cd dir_name` leads to from `current` (None if it can't be known)"""
+
+        dir_name = str(dir_name)
+        if ".." in dir_name.split("/"):
+            return None # may not be the parent if symlinks are involved
+        if dir_name.startswith(("/","~")):
+            return posixpath.normpath(dir_name)
+        if current is None:
+            return None
+        return posixpath.normpath(posixpath.join(current,dir_name))
+
+    def _track_dir(self,op,args):
+        """Updates the tracked remote/local working directory after a `cd`/`lcd` step"""
+
+        attr = {"cd":"_remote_cwd","lcd":"_local_cwd"}.get(op)
+        if attr:
+            setattr(self,attr,self._next_dir(getattr(self,attr),args[0]) if len(args) == 1 else None)
+            self._cwd_steps[attr] = (len(self.actions) - 1, self.actions[-1])
+
+    def _actions_mark(self):
+        """Cheap fingerprint of `actions` (length and last step), used to notice direct edits"""
+
+        return len(self.actions), self.actions[-1] if self.actions else None
+
+    def _reset_tracked_dirs(self):
+        """Forgets the tracked remote/local working directories"""
+
+        self._remote_cwd = self._local_cwd = None
+        self._cwd_steps = {} # tracked dir attribute -> (index, cd step) that set it
+        self._tracked_mark = self._actions_mark()
+
+    def _check_tracked_dirs(self):
+        """Forgets the tracked working directories if `actions` was edited directly since they were set"""
+
+        if self._tracked_mark != self._actions_mark() or any(
+                index >= len(self.actions) or self.actions[index] is not step for index,step in self._cwd_steps.values()):
+            self._reset_tracked_dirs()
 
     def insert_step(self,index,cmd,expect=None,input_quote='"',expect_quote='"'):
         """Adds a command to be run on the command line at a given index
@@ -161,11 +717,13 @@ class Scripter:
         if not expect: expect = self.expect
         step = Step(cmd=cmd,expect=expect,input_quote=input_quote,expect_quote=expect_quote)
         self.actions = self.actions[0:index] + [step] + self.actions[index:]
+        self._dirty = True
+        self._reset_tracked_dirs() # can't tell which directory later steps start in now
 
     def is_empty(self):
         """True if no planned actions; false if any steps already exist"""
 
-        return bool(self.actions)
+        return not self.actions
 
     def get_steps(self,step_list:List[Step]=[],sep:str="\n"):
         """Joins all steps into string delimited by seperator
@@ -177,30 +735,34 @@ class Scripter:
 
         if not step_list:
             step_list = self.actions
-        return ''.join([step.__repr__(sep) for step in step_list])
+        if sep == "\n":
+            return ''.join(step._rendered for step in step_list)
+        return ''.join(step.__repr__(sep) for step in step_list)
 
     def _add_end_step(self):
         """Sends command to exit hpc. Prevents closing before done."""
 
-        if self.mode == "sftp": end = "quit"
-        elif self.mode == "ssh": end = "exit"
         # add end step if end step isn't already last step
-        if not end in self.actions[-1].action:
-            self.add_step(cmd=end)
+        if not self.actions or self.actions[-1].cmd != self._m["end"]:
+            self.basic_step(self._m["end"])
 
     def __full_command(self):
-        """Gets full `expect` command to run"""
+        """Gets full `expect` script to run (as bytes), only re-rendering it if steps changed since last time
+
+        Changes made directly to `actions` (e.g. `actions.pop()`) are noticed by comparing it to the steps last rendered.
+        """
 
         self._add_end_step()
-        return self.open + self.entry + self.get_steps(self.__pw_steps) + self.get_steps() + self.close
+        if self._dirty or self._cmd_cache is None or self._cmd_steps != self.actions:
+            self._cmd_cache = (self.open + self.entry + self.get_steps(self.__pw_steps) + self.get_steps() + self.close).encode()
+            self._cmd_steps = list(self.actions)
+            self._dirty = False
+        return self._cmd_cache
 
     def get_actions(self):
         """Creates a generator yielding all desired actions in order"""
         for step in self.actions:
-            # yield step.action.strip().replace('send "','').replace('"','') # original # TODO
-            # yield step.action.strip().replace('send "','').replace('"','\\"') # new
-            # yield repr(step.action.strip().replace('send "','').replace('"','\\"')) # new
-            yield step.action.strip().replace('send "','')
+            yield step.cmd
     
     def preview_steps(self):
         """Prints all action steps in order to stdout"""
@@ -212,24 +774,142 @@ class Scripter:
     def clear(self):
         """Remove all actions"""
 
-        self.actions:list[Step]=[]
+        self.actions.clear()
+        self._dirty = True
+        self._reset_tracked_dirs()
 
     def run(self):
-        """Runs all commands currently in self.actions"""
+        """Runs all commands currently in self.actions
+
+        Returns:
+            int | None: the exit code of `expect` (None for backend="paramiko")
+        """
+
+        if self.backend == "paramiko":
+            self._add_end_step()
+            _ParamikoBackend(self.site,self.username,self.__password,self.mode,self.__pw_steps,parallel=self.parallel).run(self.actions)
+        else:
+            # print("CMD:",self.__full_command().decode())
+            return self._stream_to_expect()
+
+    def interrupt(self):
+        """Stops a `run()` in progress (e.g. from another thread). Only affects the expect backend."""
+
+        self._interrupted.set()
+
+    def _write_script(self,stdin,script:bytes):
+        """Writes the `expect` `script` to `stdin`"""
+
+        try:
+            stdin.write(script)
+            stdin.close()
+        except (BrokenPipeError,ValueError):
+            pass # expect exited early (or was stopped); its exit code says why
+
+    def _record_output(self,chunk:bytes,stream):
+        """Echoes `chunk` to `stream` and keeps it if within the first/last `output_keep` bytes of output"""
+
+        try:
+            stream.buffer.write(chunk)
+        except AttributeError: # e.g. stream replaced by a text-only object
+            stream.write(chunk.decode(errors="replace"))
+        stream.flush()
+        self.output_size += len(chunk)
+        room = self.output_keep - len(self.output_head)
+        if room > 0:
+            self.output_head += chunk[:room]
+            chunk = chunk[room:]
+        self.output_tail.extend(chunk)
+
+    def get_output(self):
+        """Returns output of the last `run()` (expect backend only), trimmed to its first and last `output_keep` bytes"""
+
+        head = self.output_head.decode(errors="replace")
+        tail = bytes(self.output_tail).decode(errors="replace")
+        if self.output_size > len(self.output_head) + len(self.output_tail):
+            return f"{head}\n...\n{tail}"
+        return head + tail
+
+    def _stream_to_expect(self):
+        """Feeds the `expect` script to `expect` via stdin (no shell involved)
+
+        `expect` runs in its own session so it (and the sftp/ssh client it spawns) can be stopped as a group
+        when `abs_timeout` passes, no output arrives for `idle_timeout`, `interrupt()` is called, or python is interrupted.
+        (A transfer printing sftp's progress meter isn't idle.)
+        Its output is read in large chunks as soon as it's available, echoed, and kept for `get_output()`.
+
+        Returns:
+            int: the exit code of `expect` (negative if it was stopped by a signal)
+        """
 
-        # print("CMD:",self.__full_command())
-        os.system(self.__full_command())
+        script = self.__full_command()
+        self._interrupted.clear()
+        self.output_head.clear()
+        self.output_tail.clear()
+        self.output_size = 0
+        p = subprocess.Popen(["expect","-"],stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE,
+            bufsize=65536,start_new_session=True)
+        threading.Thread(target=self._write_script,args=(p.stdin,script),daemon=True).start()
+        echo_to = {p.stdout: sys.stdout, p.stderr: sys.stderr}
+        readers = list(echo_to)
+        start = last_output = time.monotonic()
+        stop = False
+        try:
+            while readers or p.poll() is None:
+                if readers:
+                    ready,_,_ = select.select(readers,[],[],self.poll_timeout)
+                else: # output is closed, but expect hasn't exited yet
+                    ready = []
+                    time.sleep(self.poll_timeout)
+                for reader in ready:
+                    chunk = os.read(reader.fileno(),65536)
+                    if chunk:
+                        self._record_output(chunk,echo_to[reader])
+                        last_output = time.monotonic()
+                    else:
+                        readers.remove(reader)
+                if not ready and p.poll() is not None:
+                    break # output pipes held open by something expect left behind
+                if self._interrupted.is_set():
+                    print("\nInterrupted. Stopping expect...")
+                    stop = True
+                    break
+                if self.abs_timeout and time.monotonic() - start > self.abs_timeout:
+                    print(f"\nStill running after {self.abs_timeout}s. Stopping expect...")
+                    stop = True
+                    break
+                if self.idle_timeout and time.monotonic() - last_output > self.idle_timeout:
+                    print(f"\nNo output for {self.idle_timeout}s. Stopping expect...")
+                    stop = True
+                    break
+        except KeyboardInterrupt:
+            self._kill(p)
+            raise
+        finally:
+            p.stdout.close()
+            p.stderr.close()
+        if stop:
+            self._kill(p)
+        return p.wait()
+
+    def _kill(self,p):
+        """Terminates `expect` process `p` and everything it spawned"""
+
+        try:
+            os.killpg(p.pid,signal.SIGTERM)
+        except ProcessLookupError:
+            pass # already gone
 
     def pwd(self):
         """Prints current working directory"""
 
-        self.add_step("pwd")
+        self.basic_step("pwd")
     
     def ls(self,dir_name=None):
         """Prints contents of hpc directory (Default: current directory) to stdout"""
 
         if not dir_name: dir_name = "."
-        self.basic_step("ls -la",dir_name)
+        self.basic_step("ls","-la",dir_name)
 
     def mkdir(self,dir_name,local):
         """Changes working directory to `dir`
@@ -240,22 +920,25 @@ class Scripter:
         """
 
         l = "l" if local else ""
-        self.add_step(f"{l}mkdir {dir_name}")
+        self.basic_step(f"{l}mkdir",dir_name)
     
     def cwd(self,dir_name,local=False):
         """Changes working directory to `dir`
+
+        No step is added if the previous steps already lead to `dir_name`.
         
         Args:
             dir_name (str | Path): directory to change to
             local (bool): A flag indicating to change local working directory (not remote)
         """
 
-        if local==True:
-            if self.mode == "sftp":
-                cd = "lcd"
-            else:
-                raise Exception("lcd only works with sftp")
-        else: cd = "cd" 
+        cd = self._m["lcd" if local else "cd"]
+        if not cd:
+            raise Exception("lcd only works with sftp")
+        self._check_tracked_dirs()
+        current = self._local_cwd if local else self._remote_cwd
+        if current is not None and self._next_dir(current,dir_name) == current:
+            return
         self.basic_step(cd,dir_name)
 
     def set_permissions(self,files,group:str=None,octal:str="0664"):
@@ -269,6 +952,9 @@ class Scripter:
             All permissions become question marks.
             To Fix: Try manually getting and putting files via sftp sometimes fixes this
 
+        Over ssh, all `files` are handed to a single `chmod` (and `chgrp`) step rather than one step per file.
+        With backend="paramiko" and `parallel` > 1, the per-file sftp steps are applied concurrently.
+
         Args:
             files (str | list): files for which to change permissions
             group (str | None): group used for `chgrp` command (if provided)
@@ -283,6 +969,11 @@ class Scripter:
                 if type(x) == int: x = str(x)
                 if type(x) == str and not x.isnumeric() and x:
                     raise TypeError(f"Invalid input ({x}, type:{type(x)}) for {n}. Numeric values must be used over sftp.")
+        if self.mode == 'ssh':
+            self.basic_step("chmod",octal,*files)
+            if self.group:
+                self.basic_step("chgrp",self.group,*files)
+            return
         for file in files:
             self.basic_step("chmod",octal,file)
             if self.group:
@@ -312,7 +1003,7 @@ class Scripter:
         """
 
         # only allow transfers via sftp
-        if self.mode != "sftp": raise Exception(f"'{trans_type}' can only be used with mode='sftp'")
+        if not self._m["transfer"]: raise Exception(f"'{trans_type}' can only be used with mode='sftp'")
         globbed_directory = self.directory_transfer_check(file)
         # determine name of outfile/new_file, if not provided
         if globbed_directory:
@@ -335,13 +1026,13 @@ class Scripter:
             self.cwd(dir_name=outdir,local=local)
 
         # TEMP: TODO remove
-        self.add_step("pwd")
+        self.pwd()
         # add transfer step
         if options:
             opt="-"+"".join(options)
-            self.basic_step(trans_type,opt,file,new_name,"\n")
+            self.basic_step(trans_type,opt,file,new_name)
         else:
-            self.basic_step(trans_type,file,new_name,"\n")
+            self.basic_step(trans_type,file,new_name)
 
     def get(self,file,outdir=None,new_name=None,options:list=[]):
         """Downloads file to current local directory or specified local outdir,
@@ -386,27 +1077,26 @@ class Scripter:
         """
 
         if outdir:
-            self.add_step(f"mkdir {outdir}") # mkdir if not present (will throw error if exists, but that's okay)
+            self.mkdir(outdir,local=False) # mkdir if not present (will throw error if exists, but that's okay)
         self.transfer("put",file,outdir,local=False,new_name=new_name,options=options)
         if set_permissions == True:
             self.set_permissions(str(Path(outdir)/Path(file).name))
 
     ### Get login info
     def write_credentials(self):
-        """Writes provided credentials to config"""
+        """Writes provided credentials to config (readable only by you)
+
+        The file is written in full beside `config` then moved into place, so an interrupted write can't leave it half-written.
+        """
 
         self.config.parent.mkdir(exist_ok=True,parents=True)
-        with self.config.open("w") as out:
+        tmp = self.config.with_name(self.config.name + ".tmp")
+        with os.fdopen(os.open(tmp,os.O_WRONLY|os.O_CREAT|os.O_TRUNC,0o600),"w") as out:
             out.write(f"username={self.username}\n")
             out.write(f"password={self.__password}\n")
-
-    def _get_credential_if_present(self,line,cred):
-        """Sets credentials (if found in `line`) to associated `cred` attribute"""
-
-        if cred in line.lower():
-            attr = line.split("=")[-1].strip()
-            if cred=="password": self.__password = attr
-            else: setattr(self,cred,attr)
+        os.chmod(tmp,0o600) # in case a stale tmp file already existed
+        os.replace(tmp,self.config)
+        _load_config.cache_clear()
 
     def read_credentials(self,config:Path):
         """Gathers credentials from `config`, if present
@@ -423,11 +1113,9 @@ class Scripter:
             '''
         """
 
-        with config.open() as fh:
-            for line in fh:
-                line = line.strip()
-                for cred in ('username','password','group','site'):
-                    self._get_credential_if_present(line,cred)
+        for cred,value in _load_config(str(config)).items():
+            if cred=="password": self.__password = value
+            else: setattr(self,cred,value)
 
     def request_credentials(self,reset_user=False,reset_pass=False):
         """Asks for any missing credentials
@@ -439,11 +1127,7 @@ class Scripter:
 
         print("Collecting your cluster login information to speed up future interactions:")
         if not self.username or reset_user==True:
-            self.username = input("Username:\n> ")
-            print(f"The username you entered is: {self.username}")
-            user_ok = input("Is this correct? (Y/n)\n> ")
-            if user_ok.strip().lower()=="n":
-                self.request_credentials(reset_user=True)
+            self._prompt_username()
         if not self.__password or reset_pass==True:
             self.__password = getpass("Password:\n> ")
         if not self.group:
@@ -451,6 +1135,17 @@ class Scripter:
         if not self.site:
             self.site = input("Enter the site you're trying to reach:\n> ")
 
+    def _prompt_username(self):
+        """Asks for `username` until the user confirms it"""
+
+        while True:
+            username = input("Username:\n> ")
+            print(f"The username you entered is: {username}")
+            user_ok = input("Is this correct? (Y/n)\n> ")
+            if user_ok.strip().lower()!="n":
+                self.username = username
+                return
+
     def reset_username(self):
         """Gets `username` and resets in `config`"""
 
@@ -476,30 +1171,26 @@ class Scripter:
         """
 
         if self.config:
-            # deal with expansion of "~" in desired config path
-            if Path("~") in list(self.config.parents):
-                if str(self.config)[0] != "~":
-                    raise Exception("Config path looks weird:",self.config)
-                else:
-                    self.config = Path(str(self.config).replace("~",str(Path.home())))
+            self.config = Path(os.path.expanduser(str(self.config))).resolve()
         else:
-            self.config = Path.home() / ".pooPatrol/hpc_config.txt"
-            self.config = self.config.resolve()
+            self.config = (Path.home() / ".pooPatrol/hpc_config.txt").resolve()
+        if (not self.username or not self.__password) and self.config.exists():
+            self.read_credentials(self.config)
+        # verify that username/password were found
         if not self.username or not self.__password:
-            if self.config.exists():
-                self.read_credentials(self.config)
-                self.get_credentials(save=save) # verify that username/password were found
+            if headless == True:
+                print(f"Config file '{self.config}' is missing variables\n"
+                    f"It should look like this:\n"
+                    f"username=youruser\n"
+                    f"password=yourpass\n\n"
+                    f"Or you need to pass in a username and/or password at {self.__class__.__name__} instantiation.")
+                exit(1)
             else:
-                if headless == True:
-                    print(f"Config file '{self.config}' is missing variables\n"
-                        f"It should look like this:\n"
-                        f"username=youruser\n"
-                        f"password=yourpass\n\n"
-                        f"Or you need to pass in a username and/or password at {self.__class__.__name__} instantiation.")
-                    exit(1)
+                if self.config.exists():
+                    print(f"Requested config ({self.config}) is missing credentials.\nGathering credentials...")
                 else:
                     print(f"Requested config not found ({self.config}).\nGathering credentials...")
-                    self.request_credentials()
+                self.request_credentials()
         if save and not self.config.exists() or overwrite:
             print(f"Writing out credentials to {self.config}")
             self.write_credentials()